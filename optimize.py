@@ -1,29 +1,9 @@
-from bisect import insort_left
+from concurrent.futures import ThreadPoolExecutor
 import argparse
+import heapq
 import numpy as np
 import matplotlib.pyplot as plt
-
-
-class Frame:
-    def __init__(self, index, value):
-        self.index = index
-        self.value = value
-        self.assigned = 0.0
-
-    def __lt__(self, other):
-        if self.value == other.value:
-            return self.index > other.index
-
-        return self.value < other.value
-
-    def assign(self, amount):
-        self.value += amount
-        self.assigned += abs(amount)
-
-
-class PriceFrame(Frame):
-    def assign(self, amount):
-        self.assigned += abs(amount)
+from numba import njit
 
 
 class ArgumentError(Exception):
@@ -32,16 +12,7 @@ class ArgumentError(Exception):
 
 
 def read_curve(path):
-    with open(path) as file:
-        data = file.readlines()
-        data = [float(datum.rstrip()) for datum in data]
-
-    return data
-
-
-def append(list, item):
-    """Can be used instead of insort_left when optimizing with price curves."""
-    list.append(item)
+    return np.loadtxt(path, dtype=np.float64)
 
 
 def mean_curve(values, samples=72):
@@ -50,13 +21,15 @@ def mean_curve(values, samples=72):
     samples means that the previous 36 hours and following 35 hours will be used to generate the
     moving average for the current hour.
     """
+    values = np.asarray(values, dtype=np.float64)
     margin = int(samples / 2)
-    wrapped = values[len(values) - margin :] + values + values[:margin]
+    wrapped = np.concatenate((values[len(values) - margin :], values, values[:margin]))
 
-    return np.resize(
-        np.convolve(wrapped, np.ones(samples), "valid") / samples,
-        len(values),
-    )
+    # The sum of each window is the difference between two points in the cumulative sum, which
+    # avoids the O(N * samples) convolution.
+    cumulative = np.concatenate(([0.0], np.cumsum(wrapped)))
+
+    return ((cumulative[samples:] - cumulative[:-samples]) / samples)[: len(values)]
 
 
 def target_curves(load_curve, mean_curve):
@@ -64,14 +37,13 @@ def target_curves(load_curve, mean_curve):
     Given the load curve and moving average mean curve, returns two new curves describing the amount
     of charging or discharging which would be needed in each hour for a new curve to match the mean.
     """
-    deviation_curve = np.array(load_curve) - np.array(mean_curve)
+    deviation_curve = load_curve - mean_curve
 
-    charging_target = [-value if value < 0.0 else 0.0 for value in deviation_curve]
+    charging_target = np.where(deviation_curve < 0.0, -deviation_curve, 0.0)
 
-    discharging_target = [
-        min(value, load_curve[index]) if value > 0.0 else 0.0
-        for (index, value) in enumerate(deviation_curve)
-    ]
+    discharging_target = np.where(
+        deviation_curve > 0.0, np.minimum(deviation_curve, load_curve), 0.0
+    )
 
     return (charging_target, discharging_target)
 
@@ -179,111 +151,98 @@ def optimize_simple(
 
 
 
-def optimize(
-    data,
+@njit(cache=True, nogil=True)
+def _find_min_frame(
+    values, reserve, charging_target, max_index, available_energy, volume, lookbehind
+):
+    """
+    Searches the lookbehind period before the max frame for the hour with the minimum value in which
+    the battery may be charged. Returns the index of that hour, or -1 if there is none, and the
+    available energy limited by the remaining volume in the period.
+    """
+    # Only charge from an hour whose value is 95% or lower than the max. Once a candidate has been
+    # found, any other must also be lower than the candidate.
+    desired_low = values[max_index] * 0.95
+
+    # Contains the hour within the lookbehind periods with the minimum value.
+    min_index = -1
+
+    for index in range(max_index - 1, max(0, max_index - lookbehind) - 1, -1):
+        if reserve[index] >= volume:
+            # We've reached a frame already at max-capacity; therefore neither it nor an earlier
+            # frame will be able to charge.
+            break
+
+        # Limit charging by the remaining volume in the frame.
+        available_energy = min(available_energy, volume - reserve[index])
+
+        if (
+            available_energy > 0
+            and charging_target[index] > 0
+            and values[index] < desired_low
+        ):
+            min_index = index
+            desired_low = values[index]
+
+    return (min_index, available_energy)
+
+
+@njit(cache=True, nogil=True)
+def _optimize_flatten(
+    values,
+    charge_frames,
     charging_target,
     discharging_target,
-    capacity=5000.0,
-    gradual=False,
-    lookbehind=72,
-    price_curve=None,
-    volume=50000.0,
+    volume,
+    lookbehind,
+    gradual,
 ):
     """
-    Runs the optimization. Returns the energy stored in the battery in each hour.
+    Compiled inner loop of the optimization when flattening the load curve. Returns the energy
+    stored in the battery in each hour.
 
     Arguments:
-    data               - The residual load curve
+    values             - The load in each hour; updated in place as energy is assigned
+    charge_frames      - Indices of the frames where there is room to discharge
     charging_target    - Curve describing the desired charging in each hour
     discharging_target - Curve describing the desired discharging in each hour
-
-    Keyword arguments:
-    volume      - The volume of the battery in MWh.
-    capacity    - The volume of the battery in MW.
-    lookbehind  - How many hours the algorithm can look into the past to search for the minimum.
-    price_curve - An optional price curve. If given, the algorithm will optimize for profit using
-                  the price curve rather than flattening the load curve.
     """
-    optimize_profit = price_curve != None
-
-    insort_max = append if optimize_profit else insort_left
-
-    # All values for the year converted to a Frame.
-    if optimize_profit:
-        frames = [PriceFrame(index, value) for (index, value) in enumerate(price_curve)]
-    else:
-        frames = [Frame(index, value) for (index, value) in enumerate(data)]
-
-    # Contains all hours where there is room to discharge, sorted in ascending order (highest value
-    # is last).
-    charge_frames = sorted(
-        [frame for frame in frames if discharging_target[frame.index] > 0]
-    )
-
     # Keeps track of how much energy is in the reserve in each hour.
-    reserve = np.zeros(len(data))
-
-    # Keeps track of how much energy has been assigned in each hour.
-    # assigned = np.zeros(len(data))
+    reserve = np.zeros_like(values)
 
-    # Convert the charging and discharging targets to ndarray, constrained by the capacity of the
-    # battery.
-    charging_target = np.array([min(capacity, value) for value in charging_target])
-    discharging_target = np.array(
-        [min(capacity, value) for value in discharging_target]
-    )
+    # A max-heap of the frames where there is room to discharge, keyed on the negated value. Frames
+    # with equal values are popped lowest index first.
+    heap = [(-values[index], index) for index in charge_frames]
+    heapq.heapify(heap)
 
-    while len(charge_frames) > 0:
-        max_frame = charge_frames.pop()
+    while len(heap) > 0:
+        max_index = heapq.heappop(heap)[1]
 
         # Eventually contains the amount of energy to be charged at the min and discharged at the
         # max frames.
-        available_energy = discharging_target[max_frame.index]
+        available_energy = discharging_target[max_index]
 
         # The frame cannot be discharged any further (no margin between current and target load or
         # the battery is already at max capacity).
         if available_energy == 0:
             continue
 
-        # Only charge from an hour whose value is 95% or lower than the max.
-        desired_low = max_frame.value * 0.95
+        (min_index, available_energy) = _find_min_frame(
+            values, reserve, charging_target, max_index, available_energy, volume, lookbehind
+        )
 
-        # Contains the hour within the lookbehind periods with the minimum value.
-        min_frame = None
-
-        for min_index in range(
-            max_frame.index - 1, max(0, max_frame.index - lookbehind) - 1, -1
-        ):
-            if reserve[min_index] >= volume:
-                # We've reached a frame already at max-capacity; therefore neither it nor an earlier
-                # frame will be able to charge.
-                break
-
-            current = frames[min_index]
-
-            # Limit charging by the remaining volume in the frame.
-            available_energy = min(available_energy, volume - reserve[min_index])
-
-            if (
-                available_energy > 0
-                and charging_target[current.index] > 0
-                and (not min_frame or current.value < min_frame.value)
-                and current.value < desired_low
-            ):
-                min_frame = current
-
-        # We now have either the min frame, or None in which case no optimisation can be performed
+        # We now have either the min frame, or none in which case no optimisation can be performed
         # on the max frame.
-        if min_frame == None:
+        if min_index == -1:
             continue
 
         # Contrain the charge/discharge by the charging target.
-        available_energy = min(available_energy, charging_target[min_frame.index])
+        available_energy = min(available_energy, charging_target[min_index])
 
-        if gradual and not optimize_profit:
+        if gradual:
             # Take the half-way point between the peak and trough, if possible.
-            upper = max_frame.value
-            lower = min_frame.value
+            upper = values[max_index]
+            lower = values[min_index]
 
             # Restrict the amount of energy assigned to be one twentieth of the difference between
             # the max and min. This allows energy to be assigned more fairly to surrounding hours in
@@ -293,23 +252,171 @@ def optimize(
         if available_energy == 0:
             continue
 
-        # Add the charge and discharge to the reserve.
-        reserve[(min_frame.index) : (max_frame.index)] += available_energy
+        # Add the charge and discharge to the reserve. The range lies within the lookbehind period
+        # which was just scanned, so updating it in place costs no more than the scan itself.
+        reserve[min_index:max_index] += available_energy
 
-        min_frame.assign(available_energy)
-        max_frame.assign(-available_energy)
+        values[min_index] += available_energy
+        values[max_index] -= available_energy
 
-        charging_target[min_frame.index] -= available_energy
-        discharging_target[max_frame.index] -= available_energy
+        charging_target[min_index] -= available_energy
+        discharging_target[max_index] -= available_energy
 
-        if discharging_target[max_frame.index] > 0:
-            insort_max(charge_frames, max_frame)
+        if discharging_target[max_index] > 0:
+            heapq.heappush(heap, (-values[max_index], max_index))
 
     return reserve
 
 
-def build_targets(args, loads, capacity):
-    if args.constraints_path == False:
+@njit(cache=True, nogil=True)
+def _optimize_profit(
+    values,
+    charge_frames,
+    charging_target,
+    discharging_target,
+    volume,
+    lookbehind,
+):
+    """
+    Compiled inner loop of the optimization when optimizing for profit. Returns the energy stored in
+    the battery in each hour.
+
+    Arguments:
+    values             - The price in each hour
+    charge_frames      - Indices of the frames where there is room to discharge, in descending order
+                         of price
+    charging_target    - Curve describing the desired charging in each hour
+    discharging_target - Curve describing the desired discharging in each hour
+    """
+    # Keeps track of how much energy is in the reserve in each hour.
+    reserve = np.zeros_like(values)
+
+    for max_index in charge_frames:
+        # Assigning energy does not change the price, so the frame remains the highest and is
+        # discharged until it can be discharged no further.
+        while discharging_target[max_index] > 0:
+            (min_index, available_energy) = _find_min_frame(
+                values,
+                reserve,
+                charging_target,
+                max_index,
+                discharging_target[max_index],
+                volume,
+                lookbehind,
+            )
+
+            if min_index == -1:
+                break
+
+            # Contrain the charge/discharge by the charging target.
+            available_energy = min(available_energy, charging_target[min_index])
+
+            if available_energy == 0:
+                break
+
+            # Add the charge and discharge to the reserve.
+            reserve[min_index:max_index] += available_energy
+
+            charging_target[min_index] -= available_energy
+            discharging_target[max_index] -= available_energy
+
+    return reserve
+
+
+def optimize(
+    data,
+    charging_target,
+    discharging_target,
+    capacity=5000.0,
+    dtype=np.float64,
+    gradual=False,
+    horizon=None,
+    lookbehind=72,
+    price_curve=None,
+    volume=50000.0,
+):
+    """
+    Runs the optimization. Returns the energy stored in the battery in each hour.
+
+    Arguments:
+    data               - The residual load curve
+    charging_target    - Curve describing the desired charging in each hour
+    discharging_target - Curve describing the desired discharging in each hour
+
+    Keyword arguments:
+    volume      - The volume of the battery in MWh.
+    capacity    - The volume of the battery in MW.
+    lookbehind  - How many hours the algorithm can look into the past to search for the minimum.
+    price_curve - An optional price curve. If given, the algorithm will optimize for profit using
+                  the price curve rather than flattening the load curve.
+    horizon     - An optional number of hours. If given, the curve is split into periods of this
+                  length which are optimized independently, each starting and ending with an empty
+                  battery.
+    dtype       - The float type of the arrays used in the optimization. np.float32 halves the
+                  memory used, but the loads and reserve are then accurate to only around seven
+                  significant digits.
+    """
+    optimize_profit = price_curve is not None
+
+    # The value of each hour; the load is adjusted as energy is assigned unless optimizing for
+    # profit.
+    values = np.array(price_curve if optimize_profit else data, dtype=dtype)
+
+    # Convert the charging and discharging targets to ndarray, constrained by the capacity of the
+    # battery.
+    charging_target = np.minimum(np.asarray(charging_target, dtype=dtype), capacity)
+    discharging_target = np.minimum(np.asarray(discharging_target, dtype=dtype), capacity)
+
+    # The kernels are compiled for the types of their arguments; fix the scalar types so that a
+    # single compiled version is used for each dtype.
+    volume = float(volume)
+    lookbehind = int(lookbehind)
+    gradual = bool(gradual)
+
+    def optimize_period(period):
+        # Contains all hours in the period where there is room to discharge.
+        charge_frames = np.flatnonzero(discharging_target[period] > 0)
+
+        if optimize_profit:
+            # Prices are never changed by the optimization, so the frames can be sorted once, from
+            # the highest price to the lowest. Frames with equal prices are ordered lowest index
+            # first.
+            prices = values[period][charge_frames]
+            charge_frames = charge_frames[np.lexsort((charge_frames, -prices))]
+
+            return _optimize_profit(
+                values[period],
+                charge_frames,
+                charging_target[period],
+                discharging_target[period],
+                volume,
+                lookbehind,
+            )
+
+        return _optimize_flatten(
+            values[period],
+            charge_frames,
+            charging_target[period],
+            discharging_target[period],
+            volume,
+            lookbehind,
+            gradual,
+        )
+
+    horizon = int(horizon or max(len(values), 1))
+    periods = [slice(start, start + horizon) for start in range(0, len(values), horizon)]
+    reserve = np.zeros(len(values), dtype=dtype)
+
+    # The kernels release the GIL, so independent periods are optimized on separate threads.
+    with ThreadPoolExecutor() as executor:
+        for (period, period_reserve) in zip(periods, executor.map(optimize_period, periods)):
+            reserve[period] = period_reserve
+
+    return reserve
+
+
+def build_targets(args, loads, mean_loads, capacity):
+    if args.constraints_path is False:
         if not args.price_path:
             raise ArgumentError(
                 "argument --no-constrain: requires that --price also be specified"
@@ -317,38 +424,38 @@ def build_targets(args, loads, capacity):
         return (np.repeat(capacity, len(loads)), np.repeat(capacity, len(loads)))
 
     if args.constraints_path:
-        charge = np.zeros(len(loads))
-        discharge = np.zeros(len(loads))
+        constraints = read_curve(args.constraints_path)
 
-        for (index, value) in enumerate(read_curve(args.constraints_path)):
-            if value < 0:
-                discharge[index] = abs(value)
-            else:
-                charge[index] = abs(value)
+        charge = np.where(constraints >= 0, constraints, 0.0)
+        discharge = np.where(constraints < 0, -constraints, 0.0)
 
         return (charge, discharge)
 
     # If we are still missing a curve, it will be based on the moving average of the load.
 
-    return target_curves(loads, mean_curve(loads))
+    return target_curves(loads, mean_loads)
 
 
 def run(args):
     """
     Runs the optimization using the args provided on the command-line.
     """
+    if args.horizon is not None and args.horizon < 1:
+        raise ArgumentError("argument --horizon: must be at least 1 hour")
+
     capacity = args.capacity or args.volume / 10
     loads = read_curve(args.input_path)
+    mean_loads = mean_curve(loads)
     prices = read_curve(args.price_path) if args.price_path else None
 
-    (charging_target, discharging_target) = build_targets(args, loads, capacity)
+    (charging_target, discharging_target) = build_targets(args, loads, mean_loads, capacity)
 
-    if not prices and not args.constraints_path:
+    if prices is None and not args.constraints_path:
         # When optimizing towards the mean, the algorithm produces better results when each value is
         # converted to the difference between itself and the target. This means that instead of
         # matching the absolute max with the absolute mean, we find hours which are furthest from
         # the target curves.
-        relative_loads = np.array(loads) - np.array(mean_curve(loads))
+        relative_loads = loads - mean_loads
     else:
         relative_loads = loads
 
@@ -359,41 +466,35 @@ def run(args):
         charging_target,
         discharging_target,
         capacity=capacity,
+        dtype=np.float32 if args.single_precision else np.float64,
         gradual=args.gradual,
+        horizon=args.horizon,
         lookbehind=args.window,
         price_curve=prices,
         volume=args.volume,
     )
 
-    with open(args.output_path, "w") as file:
-        if prices == None:
-            file.write("index,residual_load,adjusted_load,charge,soc\n")
-        else:
-            file.write("index,residual_load,adjusted_load,charge,soc,price\n")
+    charge = np.diff(reserve, prepend=0.0)
 
-        prev_load = 0.0
-        for index in range(0, len(loads)):
-            charge = reserve[index] - prev_load
+    header = "index,residual_load,adjusted_load,charge,soc"
+    columns = [np.arange(len(loads)), loads, loads + charge, charge, reserve]
 
-            file.write(str(index))
-            file.write(",")
-            file.write(str(loads[index]))
-            file.write(",")
-            file.write(str(loads[index] + charge))
-            file.write(",")
-            file.write(str(charge))
-            file.write(",")
-            file.write(str(reserve[index]))
-            if prices != None:
-                file.write(",")
-                file.write(str(prices[index]))
-            file.write("\n")
+    if prices is not None:
+        header += ",price"
+        columns.append(prices)
 
-            prev_load = reserve[index]
+    np.savetxt(
+        args.output_path,
+        np.column_stack(columns),
+        fmt=["%d"] + ["%s"] * (len(columns) - 1),
+        delimiter=",",
+        header=header,
+        comments="",
+    )
 
-    create_plot(loads, reserve, charging_target, discharging_target, capacity)
+    create_plot(loads, mean_loads, reserve, charging_target, discharging_target, capacity)
 
-def create_plot(loads_array, reserve_array, charging_target, discharging_target, capacity):
+def create_plot(loads_array, smoothed_loads, reserve_array, charging_target, discharging_target, capacity):
 
     # Initialise plot
     plt.close()
@@ -404,8 +505,7 @@ def create_plot(loads_array, reserve_array, charging_target, discharging_target,
     plt.ylabel("MW")
 
     # Creating the adjusted residual load curve
-    charge = np.diff(reserve_array)
-    charge = np.insert(charge, 1, 0.0)
+    charge = np.diff(reserve_array, prepend=0.0)
     adjusted_residual_load = loads_array + charge
 
     #### Plotting curves
@@ -417,8 +517,6 @@ def create_plot(loads_array, reserve_array, charging_target, discharging_target,
     # Creating cumulative curve (to be compared to SoC)
     cumulative_loads = np.cumsum(loads_array[plot_min:plot_max] - mean_load)
 
-    smoothed_loads = mean_curve(loads_array)
-
     plt.plot(np.array(range(plot_min,plot_max)), loads_array[plot_min:plot_max], color='g', linestyle='-', linewidth=1.0, label="Residual Load")
     plt.plot(np.array(range(plot_min,plot_max)), adjusted_residual_load[plot_min:plot_max], color='g', linestyle='-', linewidth=3.0, label="Adjusted Residual Load")
     plt.plot(np.array(range(plot_min,plot_max)), mean_load + charge[plot_min:plot_max], color='b', linestyle='-', linewidth=1.0, label="Charging behavior of battery")
@@ -468,6 +566,16 @@ parser.add_argument(
     type=int,
     help="The number of hours after charging when energy must be discharged; defaults to 72",
 )
+parser.add_argument(
+    "--horizon",
+    type=int,
+    help="Optimize the curve in independent periods of this many hours; defaults to the whole curve",
+)
+parser.add_argument(
+    "--single-precision",
+    action="store_true",
+    help="Use 32-bit floats in the optimization; uses less memory but is less precise",
+)
 
 # Profit optimization arguments.
 constraint_group = parser.add_mutually_exclusive_group()